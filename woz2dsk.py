@@ -1,5 +1,12 @@
+import array
+import bisect
+import contextlib
+import io
+import multiprocessing
 import sys
-from typing import Dict, Optional, Tuple
+from itertools import accumulate
+from operator import itemgetter, xor
+from typing import List, Optional, Tuple, Union
 
 import wozardry
 
@@ -65,6 +72,14 @@ class DataEpilogueNotFound(SectorException):
                 (self.track, self.sector))
 
 
+class BlankTrack(DiskException):
+    def __init__(self, track: int):
+        self.track = track
+
+    def __str__(self):
+        return "Track %02d contains no data" % self.track
+
+
 class InvalidNibble(DiskException):
     def __init__(self, nibble: int):
         self.nibble = nibble
@@ -99,44 +114,72 @@ ENCODE_62 = [0x96, 0x97, 0x9a, 0x9b, 0x9d, 0x9e, 0x9f, 0xa6, 0xa7,
              0xeb, 0xec, 0xed, 0xee, 0xef, 0xf2, 0xf3, 0xf4, 0xf5, 0xf6,
              0xf7, 0xf9, 0xfa, 0xfb, 0xfc, 0xfd, 0xfe, 0xff]
 
+# Marks nibbles that are not valid 6,2-encoded values in DECODE_62_LUT
+INVALID_62_NIBBLE = 0xff
+
+
+def _build_decode_62_lut() -> bytes:
+    lut = bytearray([INVALID_62_NIBBLE] * 256)
+    for value, nibble in enumerate(ENCODE_62):
+        lut[nibble] = value
+    return bytes(lut)
+
+
 # Maps 6,2-encoded nibble to 6-bit data
-DECODE_62_MAP = dict((v, k) for k, v in enumerate(ENCODE_62))
+DECODE_62_LUT = _build_decode_62_lut()
 
 
-def swap_bits(bits):
-    return ((bits & 0b1) << 1) ^ ((bits & 0b10) >> 1)
+# Maps 2-bit value to the same value with its bits swapped
+SWAP_BITS = bytes([0b00, 0b10, 0b01, 0b11])
 
 
-def decode_62_nibble(nibble: int) -> int:
-    try:
-        return DECODE_62_MAP[nibble]
-    except KeyError:
-        raise InvalidNibble(nibble)
+def _build_swap_table(shift: int) -> bytes:
+    return bytes(SWAP_BITS[(checksum >> shift) & 0b11]
+                 for checksum in range(256))
 
 
-def decode_62(data: bytearray) -> Tuple[bytearray, int]:
-    assert len(data) == 342, len(data)
-    output = bytearray(256)
+# Translation tables from the running checksum of the first 86 nibbles to
+# the low 2 bits of each third of the output
+SWAP_LOW2 = _build_swap_table(0)
+SWAP_MID2 = _build_swap_table(2)
+SWAP_HI2 = _build_swap_table(4)
 
-    running_checksum = 0x00
-    for idx, nibble in enumerate(data[:86]):
-        running_checksum ^= decode_62_nibble(nibble)
+# Translation table from the running checksum of the last 256 nibbles to the
+# high 6 bits of the output
+SHIFT_HIGH6 = bytes((checksum << 2) & 0xff for checksum in range(256))
 
-        low2 = (running_checksum >> 0) & 0b11
-        output[idx] ^= swap_bits(low2)
 
-        mid2 = (running_checksum >> 2) & 0b11
-        output[idx + 86] ^= swap_bits(mid2)
+# Decodes 342 6,2-encoded nibbles followed by the checksum nibble.  Returns the
+# decoded data and -1, or None and the index of the first invalid nibble (342
+# for the checksum nibble).  The data is also None if the checksum doesn't
+# match.
+def decode_62(data: bytearray) -> Tuple[Optional[bytes], int]:
+    assert len(data) == 343, len(data)
+    values = data.translate(DECODE_62_LUT)
+    invalid_idx = values.find(INVALID_62_NIBBLE)
+    if invalid_idx >= 0:
+        return None, invalid_idx
 
-        if idx < 84:
-            hi2 = (running_checksum >> 4) & 0b11
-            output[idx + 86 * 2] ^= swap_bits(hi2)
+    # Running checksum after each nibble: the first 86 values carry the low 2
+    # bits of each output byte and the next 256 values the high 6 bits.  The
+    # checksum nibble holds the final running checksum, so including it in
+    # the XOR leaves zero if the data is intact.
+    checksums = bytes(accumulate(values, xor))
+    aux_checksums = checksums[:86]
+    data_checksums = checksums[86:342]
 
-    for idx, nibble in enumerate(data[86:]):
-        running_checksum ^= decode_62_nibble(nibble)
-        output[idx] ^= running_checksum << 2
+    # Build the low and high bits as separate contiguous streams; they don't
+    # overlap, so they can then be merged in a single step.
+    low2 = (aux_checksums.translate(SWAP_LOW2) +
+            aux_checksums.translate(SWAP_MID2) +
+            aux_checksums[:84].translate(SWAP_HI2))
+    high6 = data_checksums.translate(SHIFT_HIGH6)
+    output = (int.from_bytes(low2, "big") |
+              int.from_bytes(high6, "big")).to_bytes(256, "big")
 
-    return output, running_checksum
+    if checksums[-1]:
+        return None, -1
+    return output, -1
 
 
 class Sector:
@@ -147,7 +190,7 @@ class Sector:
             self, volume_num: Optional[int],
             track_num: Optional[int],
             sector_num: int,
-            data: Optional[bytearray] = None,
+            data: Optional[bytes] = None,
     ):
         if data and len(data) != 256:
             raise ValueError("Sector data is %d bytes != 256" % len(data))
@@ -158,6 +201,25 @@ class Sector:
         self.data = data or bytearray(256)
 
 
+# Picks out a track's sectors, indexed by sector number, in DOS 3.3 order
+DOS_33_INTERLEAVE = itemgetter(*Sector.DOS_33_ORDER)
+
+
+# Maps the "0"/"1" string of a nibble's 8 bits to its value, which is a
+# cheaper lookup than parsing with int(..., 2)
+BITS_TO_NIBBLE = {format(nibble, "08b"): nibble
+                  for nibble in range(0x80, 0x100)}
+
+
+# Number of nibbles decoded from the track bits at a time; a bit more than a
+# sector's data field
+NIBBLES_PER_CHUNK = 512
+
+
+# Written in place of sectors that could not be read
+EMPTY_SECTOR_DATA = bytes(256)
+
+
 class Track:
     def __init__(self, track_num: int, track: wozardry.Track,
                  address_prologue: bytes = None,
@@ -172,38 +234,140 @@ class Track:
         self.data_prologue = data_prologue or DEFAULT_DATA_PROLOGUE
         self.data_epilogue = data_epilogue or DEFAULT_DATA_EPILOGUE
 
-    def find_within(self, sequence, num_nibbles: int) -> bool:
-        seen = [0] * len(sequence)
-        cnt = 0
-        while cnt < num_nibbles:
-            del seen[0]
-            seen.append(next(self.track.nibble()))
-            if tuple(seen) == tuple(sequence):
+        # Sequences for find_within().  The last epilogue nibble is skipped
+        # since it's often not written completely.
+        self._address_epilogue_match = self.address_epilogue[:2]
+        self._data_epilogue_match = self.data_epilogue[:2]
+
+        # Track bits as a string of "0"/"1" characters, repeated so that sync
+        # bits and nibbles wrapping past the end of the track can be read
+        # without special cases
+        bits = track.bits.to01()
+        self._bit_string = bits + bits + bits[:8]
+
+        # Nibbles are decoded from the track in chunks, so that searching them
+        # can use bytearray.find().  _nibble_ends holds the absolute bit
+        # position (i.e. counting revolutions) following each nibble, and
+        # _nibble_idx is the index of the next nibble to read.
+        self._nibbles = bytearray()
+        self._nibble_ends = array.array("q")
+        self._nibble_idx = 0
+        self._start_position = (
+            track.revolutions * track.bit_count + track.bit_index)
+
+    def _decode_nibbles(self) -> None:
+        # Decodes the next chunk of nibbles.  str.find() skips over the sync
+        # bits and the nibble's bits are looked up directly, instead of
+        # constructing a generator for every bit and nibble like
+        # wozardry.Track.nibble() does.
+        bit_string = self._bit_string
+        find = bit_string.find
+        bits_to_nibble = BITS_TO_NIBBLE
+        nibbles = self._nibbles
+        nibble_ends = self._nibble_ends
+
+        bit_count = self.track.bit_count
+        position = (nibble_ends[-1] if nibble_ends else self._start_position)
+        base, bit_index = divmod(position, bit_count)
+        base *= bit_count
+        for _ in range(NIBBLES_PER_CHUNK):
+            start = find("1", bit_index)
+            if start < 0:
+                # The bit string covers a full revolution from any bit_index,
+                # so there are no 1 bits anywhere on the track
+                raise BlankTrack(self.track_num)
+            bit_index = start + 8
+            nibbles.append(bits_to_nibble[bit_string[start:bit_index]])
+            if bit_index >= bit_count:
+                revolutions, bit_index = divmod(bit_index, bit_count)
+                base += revolutions * bit_count
+            nibble_ends.append(base + bit_index)
+
+    def _seek_nibble(self, nibble_idx: int) -> None:
+        # Moves to the given nibble index, keeping the wozardry track's
+        # position in step with ours
+        self._nibble_idx = nibble_idx
+        position = (self._nibble_ends[nibble_idx - 1] if nibble_idx
+                    else self._start_position)
+        track = self.track
+        track.revolutions, track.bit_index = divmod(position, track.bit_count)
+
+    def _peek(self, num_nibbles: int) -> int:
+        # Ensures the next num_nibbles nibbles are decoded, and returns the
+        # index following them
+        end_idx = self._nibble_idx + num_nibbles
+        while len(self._nibbles) < end_idx:
+            self._decode_nibbles()
+        return end_idx
+
+    def read_nibble(self) -> int:
+        # Equivalent to next(self.track.nibble())
+        idx = self._nibble_idx
+        self._seek_nibble(self._peek(1))
+        return self._nibbles[idx]
+
+    def read_nibbles(self, num_nibbles: int) -> bytearray:
+        # Returns the next num_nibbles nibbles
+        start_idx = self._nibble_idx
+        end_idx = self._peek(num_nibbles)
+        self._seek_nibble(end_idx)
+        return self._nibbles[start_idx:end_idx]
+
+    def find(self, sequence: bytes) -> bool:
+        # Equivalent to self.track.find(): searches for sequence until the
+        # end of the next full revolution of the track
+        stop_position = (self.track.revolutions + 2) * self.track.bit_count
+        search_idx = self._nibble_idx
+        while True:
+            if self._nibble_ends and self._nibble_ends[-1] >= stop_position:
+                # The nibble that completes the revolution is still checked
+                end_idx = bisect.bisect_left(
+                    self._nibble_ends, stop_position, search_idx) + 1
+                return self._find_before(sequence, end_idx)
+
+            found_idx = self._nibbles.find(sequence, search_idx)
+            if found_idx >= 0:
+                self._seek_nibble(found_idx + len(sequence))
                 return True
-            cnt += 1
-        return False
-
-    def next_sector(self) -> Sector:
-        self.track.find(self.address_prologue)
-        volume = decode_44(next(self.track.nibble()),
-                           next(self.track.nibble()))
-        track_num = decode_44(next(self.track.nibble()),
-                              next(self.track.nibble()))
-        sector_num = decode_44(next(self.track.nibble()),
-                               next(self.track.nibble()))
+            # Resume where a partial match could start
+            search_idx = max(
+                search_idx, len(self._nibbles) - len(sequence) + 1)
+            self._decode_nibbles()
+
+    def find_within(self, sequence: bytes, num_nibbles: int) -> bool:
+        return self._find_before(sequence, self._peek(num_nibbles))
+
+    def _find_before(self, sequence: bytes, end_idx: int) -> bool:
+        # Moves past the first occurrence of sequence before end_idx, or to
+        # end_idx if there is none
+        found_idx = self._nibbles.find(sequence, self._nibble_idx, end_idx)
+        if found_idx < 0:
+            self._seek_nibble(end_idx)
+            return False
+        self._seek_nibble(found_idx + len(sequence))
+        return True
+
+    def _read_sector(self) -> Union[Sector, SectorException]:
+        # Like next_sector(), but returns rather than raises the error for a
+        # bad sector, since on a damaged disk that's the common case.
+        self.find(self.address_prologue)
+        read_nibble = self.read_nibble
+        decode = decode_44
+        volume = decode(read_nibble(), read_nibble())
+        track_num = decode(read_nibble(), read_nibble())
+        sector_num = decode(read_nibble(), read_nibble())
         if self.track_num != track_num:
-            raise TrackMismatch(self.track_num, track_num, sector_num)
+            return TrackMismatch(self.track_num, track_num, sector_num)
 
-        checksum = decode_44(next(self.track.nibble()),
-                             next(self.track.nibble()))
+        checksum = decode(read_nibble(), read_nibble())
         expected_checksum = volume ^ self.track_num ^ sector_num
         if checksum != expected_checksum:
-            raise AddressChecksumMismatch(self.track_num, sector_num)
+            return AddressChecksumMismatch(self.track_num, sector_num)
 
-        if not self.find_within(self.address_epilogue[:2], 2):
-            raise AddressEpilogueNotFound(self.track_num, sector_num)
+        if not self.find_within(self._address_epilogue_match, 2):
+            return AddressEpilogueNotFound(self.track_num, sector_num)
         # Skip last epilogue nibble since it's often not written completely
-        _ = next(self.track.nibble())
+        _ = read_nibble()
 
         # Don't bother matching explicitly for the sync bytes before the data
         # prologue.  If they're corrupt then physical hardware may not be able
@@ -214,56 +378,69 @@ class Track:
         # but not so large that we'd possibly skip into the next sector if this
         # one is corrupt.
         if not self.find_within(self.data_prologue, 20):
-            raise DataPrologueNotFound(self.track_num, sector_num)
+            return DataPrologueNotFound(self.track_num, sector_num)
 
-        nibbles = bytearray()
-        for _ in range(342):
-            nibbles.append(next(self.track.nibble()))
-        try:
-            data, checksum = decode_62(nibbles)
-        except InvalidNibble as e:
-            print(e)
-            raise BadData(self.track_num, sector_num)
-
-        try:
-            expected_checksum = decode_62_nibble(next(self.track.nibble()))
-        except InvalidNibble as e:
+        nibbles = self.read_nibbles(343)
+        data, invalid_idx = decode_62(nibbles)
+        if invalid_idx == 342:
             # TODO: the data is still possibly correct even though we can't
             #  verify the checksum, so optionally allow it.
-            print(e)
-            raise UnverifiableChecksum(self.track_num, sector_num)
-        if checksum != expected_checksum:
-            raise DataChecksumMismatch(self.track_num, sector_num)
-
-        if not self.find_within(self.data_epilogue[:2], 2):
-            raise DataEpilogueNotFound(self.track_num, sector_num)
+            print(InvalidNibble(nibbles[invalid_idx]))
+            return UnverifiableChecksum(self.track_num, sector_num)
+        if invalid_idx >= 0:
+            print(InvalidNibble(nibbles[invalid_idx]))
+            # Leave the checksum nibble unread, since we didn't get that far
+            self._seek_nibble(self._nibble_idx - 1)
+            return BadData(self.track_num, sector_num)
+        if data is None:
+            return DataChecksumMismatch(self.track_num, sector_num)
+
+        if not self.find_within(self._data_epilogue_match, 2):
+            return DataEpilogueNotFound(self.track_num, sector_num)
         # Skip last epilogue nibble since it's often not written completely
-        _ = next(self.track.nibble())
+        _ = read_nibble()
 
         return Sector(volume, track_num, sector_num, data)
 
-    def sectors(self) -> Dict[int, Optional[Sector]]:
-        sectors = {}
-        bit_indexes = {}
+    def next_sector(self) -> Sector:
+        sector = self._read_sector()
+        if isinstance(sector, SectorException):
+            raise sector
+        return sector
+
+    def sectors(self) -> Tuple[List[Optional[Sector]], int]:
+        # Returns the sectors indexed by sector number (None if unreadable),
+        # and a bitmask of the sector numbers that were found at all
+        sectors = [None] * 16  # type: List[Optional[Sector]]
+        found = 0
+        # Indexed by any sector number that decode_44() can produce, since a
+        # corrupt address field can still be seen again on the next revolution
+        bit_indexes = [None] * 256  # type: List[Optional[int]]
         while True:
-            sector = None
-            try:
-                sector = self.next_sector()
+            sector = self._read_sector()
+            if isinstance(sector, SectorException):
+                print(sector)
+                sector_num = sector.sector
+                sector = None
+            else:
                 sector_num = sector.sector_num
-            except SectorException as e:
-                print(e)
-                sector_num = e.sector
-            if sector_num in sectors:
-                old_bit_idx = bit_indexes[sector_num]
+            old_bit_idx = bit_indexes[sector_num]
+            if old_bit_idx is not None:
                 if old_bit_idx == self.track.bit_index:
                     break
                 else:
                     print(DuplicateSector(self.track_num, sector_num))
             else:
-                sectors[sector_num] = sector
                 bit_indexes[sector_num] = self.track.bit_index
+                if sector_num < 16:
+                    sectors[sector_num] = sector
+                    found |= 1 << sector_num
+
+        return sectors, found
+
 
-        return sectors
+# Bitmask returned by Track.sectors() when every sector was found
+ALL_SECTORS_FOUND = 0xffff
 
 
 class Disk:
@@ -287,40 +464,75 @@ class Disk:
             return None
 
 
+# Disk being converted by this process; see _init_worker()
+_worker_disk = None  # type: Optional[Disk]
+
+
+def _init_worker(woz_data: bytes) -> None:
+    # wozardry objects can't be pickled.  Forked workers inherit the image
+    # already parsed by main(), and only workers started from scratch (e.g.
+    # on Windows or macOS) need to parse their own copy of the file contents,
+    # which main() has already checked can be parsed.
+    global _worker_disk
+    if _worker_disk is None:
+        _worker_disk = Disk(wozardry.WozDiskImage(io.BytesIO(woz_data)))
+
+
+def _decode_track(track_num: int) -> Tuple[
+        Optional[Tuple[List[Optional[Sector]], int]], str]:
+    # Tracks are decoded concurrently, so capture any errors printed along the
+    # way and leave it to the parent process to print them in track order.
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        track = _worker_disk.seek(track_num)
+        try:
+            sectors = track.sectors() if track else None
+        except BlankTrack as e:
+            print(e)
+            sectors = None
+    return sectors, log.getvalue()
+
+
 def main(argv):
     if len(argv) != 3:
         raise ValueError("woz2dsk.py <file.woz> <output.dsk>")
 
+    # Read the file only once, since it may be a pipe, and parse it before
+    # starting the worker processes so that errors are reported up front and
+    # forked workers don't need to parse it again
+    global _worker_disk
     with open(argv[1], "rb") as fp:
-        try:
-            woz_image = wozardry.WozDiskImage(fp)
-        except wozardry.WozError as e:
-            print("Unable to read %s: %s" % (argv[1], e), file=sys.stderr)
-            sys.exit(1)
+        woz_data = fp.read()
+    try:
+        _worker_disk = Disk(wozardry.WozDiskImage(io.BytesIO(woz_data)))
+    except wozardry.WozError as e:
+        print("Unable to read %s: %s" % (argv[1], e), file=sys.stderr)
+        sys.exit(1)
 
-    disk = Disk(woz_image)
     errors = False
-    with open(argv[2], "wb") as fp:
-        for track_num in range(35):
-            track = disk.seek(track_num)
-            if not track:
+    with multiprocessing.Pool(
+            initializer=_init_worker, initargs=(woz_data,)) as pool, \
+            open(argv[2], "wb") as fp:
+        results = pool.imap(_decode_track, range(35))
+        for track_num, (track_sectors, log) in enumerate(results):
+            print(log, end="")
+            if track_sectors is None:
                 print("Track %02d missing" % track_num)
-                sectors = {}
+                sectors = [None] * 16
                 errors = True
             else:
-                sectors = track.sectors()
-                missing_sectors = set(range(16)) - set(sectors.keys())
-                if missing_sectors:
+                sectors, found = track_sectors
+                if found != ALL_SECTORS_FOUND:
                     print("Track %02d: missing sectors: %s" % (
                         track_num, " ".join(
-                            str(s) for s in sorted(list(missing_sectors)))))
+                            str(s) for s in range(16)
+                            if not found & (1 << s))))
                     errors = True
-            for sector_num in Sector.DOS_33_ORDER:
-                sector = sectors.get(sector_num)
-                if not sector:
-                    sector = Sector(None, track_num, sector_num)
-                    errors = True
-                fp.write(sector.data)
+            if None in sectors:
+                errors = True
+            sector_data = [sector.data if sector else EMPTY_SECTOR_DATA
+                           for sector in sectors]
+            fp.write(b"".join(DOS_33_INTERLEAVE(sector_data)))
 
     if errors:
         sys.exit(1)